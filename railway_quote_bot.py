@@ -5,12 +5,12 @@ Sequential version - posts rows in order without duplicates
 """
 
 import os
+import sys
 import json
 import logging
+import threading
+import unicodedata
 from datetime import datetime
-import tweepy
-import gspread
-from google.oauth2.service_account import Credentials
 
 # Set up logging for Railway
 logging.basicConfig(
@@ -20,27 +20,105 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Checked before the heavy API client modules are imported
+REQUIRED_ENV_VARS = [
+    'TWITTER_BEARER_TOKEN',
+    'TWITTER_CONSUMER_KEY',
+    'TWITTER_CONSUMER_SECRET',
+    'TWITTER_ACCESS_TOKEN',
+    'TWITTER_ACCESS_TOKEN_SECRET',
+    'GOOGLE_SERVICE_ACCOUNT_JSON',
+    'GOOGLE_SHEETS_ID',
+]
+
+# Optional: point QUOTE_BOT_STATE_FILE at a persistent volume (e.g. a Railway
+# volume mount, not /tmp) to keep the row index locally and only sync it to the
+# tracking sheet every SHEETS_SYNC_EVERY runs (or when it moves backwards, e.g.
+# wrap-around). If unset, the tracking sheet is updated every run. Losing the
+# file can repost up to SHEETS_SYNC_EVERY - 1 quotes. QUOTE_BOT_SYNC_EVERY
+# overrides the interval and is validated in main().
+STATE_FILE = os.getenv('QUOTE_BOT_STATE_FILE')
+SHEETS_SYNC_EVERY = 10
+
+# API clients are reused across bot instances in the same process, so warm
+# re-invocations skip the OAuth handshake and open_by_key call
+_CLIENT_LOCK = threading.Lock()
+_GSPREAD_CLIENT = None
+_SPREADSHEET = None
+_TWITTER_CLIENT = None
+
+# Twitter counts weighted characters: code points in these ranges cost 1,
+# everything else (CJK, emoji, ...) costs 2 (twitter-text v3 config)
+TWEET_MAX_WEIGHT = 280
+LIGHT_CHAR_RANGES = [(0, 4351), (8192, 8205), (8208, 8223), (8242, 8247)]
+
+def _char_weight(char):
+    """Weight of a single code point in Twitter's length count"""
+    code_point = ord(char)
+    for start, end in LIGHT_CHAR_RANGES:
+        if start <= code_point <= end:
+            return 1
+    return 2
+
+def _tweet_weight(text):
+    """Twitter weighted length of text (emoji sequences are overcounted, never under)"""
+    return sum(_char_weight(char) for char in unicodedata.normalize('NFC', text))
+
+def _truncate_to_weight(text, max_weight):
+    """Longest prefix of text whose weighted length fits in max_weight"""
+    text = unicodedata.normalize('NFC', text)
+    weight = 0
+    for index, char in enumerate(text):
+        weight += _char_weight(char)
+        if weight > max_weight:
+            return text[:index]
+    return text
+
+# Twitter rejections caused by the tweet itself (duplicate status, too long);
+# other 400/403s (permissions, suspended account, ...) must not skip the row
+CONTENT_REJECTION_CODES = {186, 187}
+CONTENT_REJECTION_MESSAGES = ('duplicate', 'too long')
+
+def _is_content_rejection(error):
+    """Whether a tweepy HTTPException rejects the tweet's content rather than the request"""
+    if CONTENT_REJECTION_CODES.intersection(error.api_codes):
+        return True
+    messages = ' '.join(error.api_messages).lower()
+    return any(message in messages for message in CONTENT_REJECTION_MESSAGES)
+
 class RailwayQuoteBot:
-    def __init__(self):
+    def __init__(self, sync_every=SHEETS_SYNC_EVERY):
         """Initialize the Railway Quote Bot"""
+        self.sync_every = sync_every  # Runs between tracking sheet syncs with local state
+        self._total_rows = 0  # Cached quote row count (tracking sheet A2)
+        self.tracking_sheet = None
+        self._tracking_values = None
+        self._local_state = None
+        self._sheet_row = 2  # Row index as last synced to the tracking sheet
         self.setup_twitter()
         self.setup_google_sheets()
+        self.resolve_twitter_username()
         
     def setup_twitter(self):
         """Initialize Twitter API connection"""
+        import tweepy  # Imported lazily to keep cold starts fast
+        
+        global _TWITTER_CLIENT
+        
         try:
-            self.twitter_client = tweepy.Client(
-                bearer_token=os.getenv('TWITTER_BEARER_TOKEN'),
-                consumer_key=os.getenv('TWITTER_CONSUMER_KEY'),
-                consumer_secret=os.getenv('TWITTER_CONSUMER_SECRET'),
-                access_token=os.getenv('TWITTER_ACCESS_TOKEN'),
-                access_token_secret=os.getenv('TWITTER_ACCESS_TOKEN_SECRET'),
-                wait_on_rate_limit=True
-            )
-            
-            # Test connection
-            me = self.twitter_client.get_me()
-            logger.info(f"Twitter API connected successfully! User: @{me.data.username}")
+            with _CLIENT_LOCK:
+                if _TWITTER_CLIENT is None:
+                    _TWITTER_CLIENT = tweepy.Client(
+                        bearer_token=os.getenv('TWITTER_BEARER_TOKEN'),
+                        consumer_key=os.getenv('TWITTER_CONSUMER_KEY'),
+                        consumer_secret=os.getenv('TWITTER_CONSUMER_SECRET'),
+                        access_token=os.getenv('TWITTER_ACCESS_TOKEN'),
+                        access_token_secret=os.getenv('TWITTER_ACCESS_TOKEN_SECRET'),
+                        wait_on_rate_limit=False  # Fail fast; sleeping up to 15 min burns container time
+                    )
+            self.twitter_client = _TWITTER_CLIENT
+            
+            logger.info("Twitter API client initialized!")
             
         except Exception as e:
             logger.error(f"Twitter API connection failed: {str(e)}")
@@ -48,33 +126,53 @@ class RailwayQuoteBot:
     
     def setup_google_sheets(self):
         """Initialize Google Sheets API connection"""
+        import gspread  # Imported lazily to keep cold starts fast
+        from google.oauth2.service_account import Credentials
         try:
-            # Get service account info from environment variable
-            service_account_json = os.getenv('GOOGLE_SERVICE_ACCOUNT_JSON')
-            if not service_account_json:
-                raise ValueError("GOOGLE_SERVICE_ACCOUNT_JSON environment variable not set")
-            
-            # Parse JSON and create credentials
-            service_account_info = json.loads(service_account_json)
-            scopes = [
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ]
-            
-            credentials = Credentials.from_service_account_info(
-                service_account_info, 
-                scopes=scopes
-            )
-            
-            # Initialize Google Sheets client
-            self.gc = gspread.authorize(credentials)
-            
-            # Open spreadsheet
-            sheets_id = os.getenv('GOOGLE_SHEETS_ID')
-            worksheet_name = os.getenv('GOOGLE_WORKSHEET_NAME', 'Sheet1')
+            import orjson as _json  # Faster service account JSON parsing on cold starts
+        except ImportError:
+            import json as _json
+        
+        global _GSPREAD_CLIENT, _SPREADSHEET
+        
+        try:
+            with _CLIENT_LOCK:
+                if _GSPREAD_CLIENT is None:
+                    # Get service account info from environment variable
+                    service_account_json = os.getenv('GOOGLE_SERVICE_ACCOUNT_JSON')
+                    if not service_account_json:
+                        raise ValueError("GOOGLE_SERVICE_ACCOUNT_JSON environment variable not set")
+                    
+                    # Parse JSON and create credentials
+                    service_account_info = _json.loads(service_account_json)
+                    scopes = [
+                        'https://www.googleapis.com/auth/spreadsheets',
+                        'https://www.googleapis.com/auth/drive'
+                    ]
+                    
+                    credentials = Credentials.from_service_account_info(
+                        service_account_info, 
+                        scopes=scopes
+                    )
+                    
+                    # Initialize Google Sheets client
+                    _GSPREAD_CLIENT = gspread.authorize(credentials)
+                
+                # Open spreadsheet
+                if _SPREADSHEET is None:
+                    _SPREADSHEET = _GSPREAD_CLIENT.open_by_key(os.getenv('GOOGLE_SHEETS_ID'))
             
-            self.sheet = self.gc.open_by_key(sheets_id)
-            self.worksheet = self.sheet.worksheet(worksheet_name)
+            self.gc = _GSPREAD_CLIENT
+            self.sheet = _SPREADSHEET
+            
+            # Looked up every run: its row_count must reflect rows added since.
+            # One metadata fetch finds both the quotes and the tracking worksheet
+            worksheet_name = os.getenv('GOOGLE_WORKSHEET_NAME', 'Sheet1')
+            worksheets = {ws.title: ws for ws in self.sheet.worksheets()}
+            if worksheet_name not in worksheets:
+                raise gspread.exceptions.WorksheetNotFound(worksheet_name)
+            self.worksheet = worksheets[worksheet_name]
+            self.tracking_sheet = worksheets.get('tracking')
             
             logger.info("Google Sheets API connected successfully!")
             
@@ -82,43 +180,171 @@ class RailwayQuoteBot:
             logger.error(f"Google Sheets API connection failed: {str(e)}")
             raise
     
-    def get_current_row_index(self):
-        """Get the current row index from tracking sheet or column"""
+    def resolve_twitter_username(self):
+        """Get the bot's Twitter username from env, tracking sheet (B1) or get_me()"""
         try:
-            # Try to get tracking sheet first
-            try:
-                tracking_sheet = self.sheet.worksheet('tracking')
-                current_row = tracking_sheet.cell(1, 1).value
-                return int(current_row) if current_row else 2  # Start from row 2 (after headers)
-            except:
+            # get_me() sits in a small rate limit window, so only call it once
+            # and reuse the username from env or the tracking sheet afterwards
+            self.twitter_username = os.getenv('TWITTER_USERNAME') or self.get_tracking_cell(0, 1)
+            if not self.twitter_username:
+                me = self.twitter_client.get_me()
+                self.twitter_username = me.data.username
+            logger.info(f"Twitter user: @{self.twitter_username}")
+            
+        except Exception as e:
+            logger.error(f"Error resolving Twitter username: {str(e)}")
+            raise
+    
+    def get_tracking_values(self):
+        """Read the tracking cells (A1 row, A2 total rows, B1 username) once per run"""
+        if self._tracking_values is None:
+            # Tracking sheet was looked up from the metadata fetched in setup_google_sheets,
+            # so a transient API error can't be mistaken for a missing sheet
+            if self.tracking_sheet is None:
                 # If tracking sheet doesn't exist, create it
                 logger.info("Creating tracking sheet...")
-                tracking_sheet = self.sheet.add_worksheet(title='tracking', rows=1, cols=1)
-                tracking_sheet.update('A1', '2')  # Start from row 2
-                return 2
+                self.tracking_sheet = self.sheet.add_worksheet(title='tracking', rows=2, cols=2)
+                # Start from row 2; written to the sheet with the first index update
+                self._tracking_values = [['2']]
+                return self._tracking_values
+            
+            if self.tracking_sheet.row_count < 2 or self.tracking_sheet.col_count < 2:
+                # Older tracking sheets were created 1x1
+                self.tracking_sheet.resize(
+                    rows=max(self.tracking_sheet.row_count, 2),
+                    cols=max(self.tracking_sheet.col_count, 2)
+                )
+            
+            # All tracking cells fetched in a single values read (no grid metadata)
+            self._tracking_values = self.sheet.values_get('tracking!A1:B2').get('values', [])
+        return self._tracking_values
+    
+    def get_tracking_cell(self, row, col):
+        """Get a single tracking value (0-based row/col), or None if empty"""
+        values = self.get_tracking_values()
+        if row < len(values) and col < len(values[row]):
+            return values[row][col] or None
+        return None
+    
+    def load_local_state(self):
+        """Load the row index saved locally by the previous run, if any"""
+        if not STATE_FILE:
+            return None
+        
+        try:
+            with open(STATE_FILE) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error reading local state: {str(e)}")
+            return None
+        
+        if not isinstance(state, dict):
+            logger.error("Ignoring local state: not a JSON object")
+            return None
+        return state
+    
+    def save_local_state(self, state):
+        """Save the row index locally for the next run; returns whether it was saved"""
+        if not STATE_FILE:
+            return False
+        
+        try:
+            tmp_path = f'{STATE_FILE}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, STATE_FILE)  # Atomic, so a crash can't leave half a file
+            return True
+        except Exception as e:
+            logger.error(f"Error saving local state: {str(e)}")
+            return False
+    
+    def get_current_row_index(self):
+        """Get the current row index and cached row count from local state and tracking sheet"""
+        try:
+            current_row = self.get_tracking_cell(0, 0)
+            total_rows = self.get_tracking_cell(1, 0)
+            self._sheet_row = int(current_row) if current_row else 2  # Start from row 2 (after headers)
+            self._total_rows = int(total_rows) if total_rows else 0
+            
+            # The sheet may lag behind the local file between syncs, so take the furthest row
+            self._local_state = self.load_local_state()
+            if self._local_state:
+                self._total_rows = self._local_state.get('total_rows', self._total_rows)
+                return max(self._sheet_row, self._local_state.get('current_row', 2))
+            return self._sheet_row
                 
         except Exception as e:
+            # Don't fall back to row 2: posting it would overwrite the real index
             logger.error(f"Error getting current row index: {str(e)}")
-            return 2  # Default to row 2
+            raise
     
     def update_current_row_index(self, new_row):
-        """Update the current row index in tracking sheet"""
-        try:
-            tracking_sheet = self.sheet.worksheet('tracking')
-            tracking_sheet.update_acell('A1', new_row)
+        """Update the current row index locally, syncing it to the tracking sheet when due"""
+        runs_since_sync = (self._local_state or {}).get('runs_since_sync', 0) + 1
+        
+        # Sync when there is no local state to rely on, when enough runs have
+        # passed, or when the row moves backwards (max() would undo it)
+        moves_backwards = new_row < self._sheet_row
+        if self._local_state is None or runs_since_sync >= self.sync_every or moves_backwards:
+            try:
+                # Write all tracking cells in one values update
+                self.sheet.values_update(
+                    'tracking!A1:B2',
+                    params={'valueInputOption': 'RAW'},
+                    body={'values': [[new_row, self.twitter_username or ''], [self._total_rows, '']]}
+                )
+                self._sheet_row = new_row
+                runs_since_sync = 0
+                logger.info(f"Synced current row to tracking sheet: {new_row}")
+            except Exception as e:
+                logger.error(f"Error updating current row index: {str(e)}")
+                if moves_backwards:
+                    # Saving locally would be undone by max() on the next run,
+                    # so keep the old state and let the next run wrap again
+                    return
+        
+        saved = self.save_local_state({
+            'current_row': new_row,
+            'total_rows': self._total_rows,
+            'runs_since_sync': runs_since_sync
+        })
+        if saved:
             logger.info(f"Updated current row to: {new_row}")
-        except Exception as e:
-            logger.error(f"Error updating current row index: {str(e)}")
+    
+    def refresh_total_rows(self):
+        """Recount the quote rows (saved with the next row index update)"""
+        # Only column A is needed to find the last quote, not the whole sheet
+        total_rows = len(self.worksheet.col_values(1))
+        self._total_rows = total_rows
+        logger.info(f"Refreshed total rows: {total_rows}")
+        return total_rows
+    
+    def read_quote_row(self, row):
+        """Read the quote and author from a single row of the quotes worksheet"""
+        row_data = self.worksheet.row_values(row)
+        
+        # Parse the row data (assuming first column is quote, second is author)
+        quote_text = row_data[0].strip() if len(row_data) > 0 and row_data[0] else None
+        author = row_data[1].strip() if len(row_data) > 1 and row_data[1] else None
+        return quote_text, author
     
     def get_next_quote(self):
         """Get the next quote in sequence"""
         try:
-            # Get current row index
+            # Get current row index (also loads the cached row count)
             current_row = self.get_current_row_index()
             
-            # Get all data to check total rows
-            all_data = self.worksheet.get_all_values()
-            total_rows = len(all_data)
+            # row_count is sheet metadata we already have, so it bounds the index for free
+            if current_row > self.worksheet.row_count:
+                current_row = 2
+                logger.info("Reached end of sheet, resetting to beginning")
+            
+            # Only recount rows when the index runs past the cached count
+            total_rows = self._total_rows
+            if current_row > total_rows:
+                total_rows = self.refresh_total_rows()
             
             # If we've gone past the last row, reset to row 2 (after headers)
             if current_row > total_rows:
@@ -127,25 +353,32 @@ class RailwayQuoteBot:
             
             # Get the specific row data
             if current_row <= total_rows:
-                row_data = all_data[current_row - 1]  # Convert to 0-based index
+                quote_text, author = self.read_quote_row(current_row)
                 
-                # Parse the row data (assuming first column is quote, second is author)
-                quote_text = row_data[0].strip() if len(row_data) > 0 and row_data[0] else None
-                author = row_data[1].strip() if len(row_data) > 1 and row_data[1] else None
+                # The cached count only grows, so an empty row may mean quotes were
+                # removed from the end of the sheet: recount and wrap if so
+                if not quote_text:
+                    total_rows = self.refresh_total_rows()
+                    if current_row > total_rows:
+                        current_row = 2
+                        logger.info("Reached end of sheet, resetting to beginning")
+                        quote_text, author = self.read_quote_row(current_row)
                 
                 if quote_text:
-                    # Update to next row for next execution
-                    next_row = current_row + 1
-                    if next_row > total_rows:
-                        next_row = 2  # Reset to beginning
-                    
-                    self.update_current_row_index(next_row)
-                    
+                    # Next row for next execution, saved only once the tweet is posted;
+                    # running past the cached count makes the next run recount and wrap
                     return {
                         'text': quote_text,
                         'author': author,
-                        'row': current_row
+                        'row': current_row,
+                        'next_row': current_row + 1
                     }
+                
+                # A blank row inside the sheet: move past it, otherwise every later
+                # run would recount and fail on the same row
+                logger.error(f"No valid quote found at row {current_row}, skipping it")
+                self.update_current_row_index(current_row + 1)
+                return None
             
             logger.error(f"No valid quote found at row {current_row}")
             return None
@@ -159,26 +392,22 @@ class RailwayQuoteBot:
         quote_text = quote_data['text']
         author = quote_data.get('author')
         
-        # Start with quoted text
-        tweet = f'{quote_text}'
-        
-        # Add author if available
-        if author:
-            tweet += f' - {author}'
+        # Author suffix is built once and only added if available
+        suffix = f' - {author}' if author else ''
+        suffix_weight = _tweet_weight(suffix)
         
-        # Ensure tweet fits Twitter's 280 character limit
-        if len(tweet) > 280:
-            max_quote_length = 280 - len(' - ') - len(author or '') - 2
-            if max_quote_length > 50:
-                quote_text = quote_text[:max_quote_length-3] + '...'
-                tweet = f'{quote_text}'
-                if author:
-                    tweet += f' - {author}'
+        # Ensure tweet fits Twitter's 280 weighted character limit
+        if _tweet_weight(quote_text) + suffix_weight > TWEET_MAX_WEIGHT:
+            max_quote_weight = TWEET_MAX_WEIGHT - suffix_weight
+            if max_quote_weight > 50:
+                quote_text = _truncate_to_weight(quote_text, max_quote_weight - 3) + '...'
         
-        return tweet
+        return quote_text + suffix
     
     def post_quote(self):
         """Main function to select and post the next quote in sequence"""
+        from tweepy.errors import BadRequest, Forbidden, TooManyRequests
+        
         try:
             logger.info("Starting sequential quote posting process...")
             
@@ -194,10 +423,20 @@ class RailwayQuoteBot:
             # Format tweet
             tweet_text = self.format_tweet(quote_data)
             
+            # format_tweet can't shorten quotes with very long authors; such a row
+            # would be rejected on every run, so skip past it instead
+            if _tweet_weight(tweet_text) > TWEET_MAX_WEIGHT:
+                logger.error(f"Skipping row {quote_data['row']}: tweet too long even after truncation")
+                self.update_current_row_index(quote_data['next_row'])
+                return False
+            
             # Post to Twitter
             response = self.twitter_client.create_tweet(text=tweet_text)
             
             if response.data:
+                # Only advance once posted, so a transient failure retries the same quote
+                self.update_current_row_index(quote_data['next_row'])
+                
                 tweet_id = response.data['id']
                 logger.info(f"Tweet posted successfully!")
                 logger.info(f"Tweet ID: {tweet_id}")
@@ -207,6 +446,21 @@ class RailwayQuoteBot:
                 logger.error("Failed to post tweet - no response data")
                 return False
                 
+        except (Forbidden, BadRequest) as e:
+            # Content rejections like a duplicate status will never succeed, so move past
+            # the row; anything else is likely config, so keep the row for the next run
+            if _is_content_rejection(e):
+                logger.error(f"Skipping row {quote_data['row']}, tweet rejected by Twitter: {str(e)}")
+                self.update_current_row_index(quote_data['next_row'])
+            else:
+                logger.error(f"Twitter refused the request, row {quote_data['row']} kept: {str(e)}")
+            return False
+        
+        except TooManyRequests as e:
+            # Exit instead of waiting for the rate limit window; the next scheduled run retries
+            logger.error(f"Twitter rate limit hit, skipping this run: {str(e)}")
+            return False
+        
         except Exception as e:
             logger.error(f"Error posting quote: {str(e)}")
             return False
@@ -217,8 +471,19 @@ def main():
         logger.info("=== Railway Quote Bot Starting (Sequential Mode) ===")
         logger.info(f"Execution time: {datetime.now()}")
         
+        # Fail fast on missing config before importing the API clients
+        missing = [name for name in REQUIRED_ENV_VARS if not os.getenv(name)]
+        if missing:
+            logger.error(f"Missing environment variables: {', '.join(missing)}")
+            sys.exit(1)
+        
+        sync_every = os.getenv('QUOTE_BOT_SYNC_EVERY', str(SHEETS_SYNC_EVERY))
+        if not sync_every.isdigit() or int(sync_every) < 1:
+            logger.error(f"QUOTE_BOT_SYNC_EVERY must be a whole number of at least 1, got: {sync_every}")
+            sys.exit(1)
+        
         # Initialize and run bot
-        bot = RailwayQuoteBot()
+        bot = RailwayQuoteBot(sync_every=int(sync_every))
         success = bot.post_quote()
         
         if success: